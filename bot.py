@@ -1,14 +1,18 @@
 import os
 import json
-import base64
 import logging
 import threading
 import asyncio
+import functools
+import random
 import time
+from collections import OrderedDict, defaultdict
+from dataclasses import dataclass, field
 from io import BytesIO
 from http.server import HTTPServer, BaseHTTPRequestHandler
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
+    AIORateLimiter,
     Application,
     CommandHandler,
     MessageHandler,
@@ -16,8 +20,12 @@ from telegram.ext import (
     ContextTypes,
     filters,
 )
+import aiosqlite
 import anthropic
 import httpx
+import orjson
+import pybase64
+from PIL import Image
 
 # ─── Config ───
 TELEGRAM_TOKEN = os.environ["TELEGRAM_TOKEN"]
@@ -25,11 +33,29 @@ ANTHROPIC_API_KEY = os.environ["ANTHROPIC_API_KEY"]
 ALLOWED_USERS = os.environ.get("ALLOWED_USERS", "")
 PORT = int(os.environ.get("PORT", 10000))
 RENDER_URL = os.environ.get("RENDER_EXTERNAL_URL", "")
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL", "")
+SESSION_DB = os.environ.get("SESSION_DB", "sessions.db")
+MIN_PHOTO_SIDE = 1024
+MAX_IMAGE_PIXELS = 1_300_000
+ANTHROPIC_MAX_RETRIES = 4
+ANTHROPIC_STREAM_ATTEMPTS = 3
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-client = anthropic.Anthropic(api_key=ANTHROPIC_API_KEY)
+# One pooled HTTP/2 client for all Anthropic calls: TLS sessions are reused between /done runs
+http_client = httpx.AsyncClient(
+    http2=True,
+    timeout=120,
+    limits=httpx.Limits(max_keepalive_connections=32, keepalive_expiry=60),
+)
+# The SDK retries 408/409/429/5xx and connection errors with jittered exponential backoff
+# when opening a request; errors inside an open stream are retried in process_invoices
+client = anthropic.AsyncAnthropic(
+    api_key=ANTHROPIC_API_KEY,
+    http_client=http_client,
+    max_retries=ANTHROPIC_MAX_RETRIES,
+)
 
 
 # ─── Health check server + auto-ping ───
@@ -62,24 +88,112 @@ def auto_ping():
 
 
 # ─── Session storage ───
-sessions = {}
+MAX_SESSIONS = 500
+SESSION_TTL = 30 * 60
+
+
+@dataclass(slots=True)
+class Session:
+    file_ids: list = field(default_factory=list)
+    unique_ids: set = field(default_factory=set)
+    shipments: list = field(default_factory=list)
+    phase: str = "collecting"
+    last_touch: float = field(default_factory=time.time)
+
+
+sessions = OrderedDict()
+locks = defaultdict(asyncio.Lock)
+db = None
+
+
+async def open_session_db():
+    global db
+    db = await aiosqlite.connect(SESSION_DB)
+    await db.execute(
+        "CREATE TABLE IF NOT EXISTS sessions (user_id INTEGER PRIMARY KEY, blob BLOB NOT NULL, ts REAL NOT NULL)"
+    )
+    await db.commit()
+
+
+async def load_session(user_id):
+    async with db.execute("SELECT blob FROM sessions WHERE user_id = ?", (user_id,)) as cursor:
+        row = await cursor.fetchone()
+    if row is None:
+        return None
+    data = orjson.loads(row[0])
+    data["unique_ids"] = set(data["unique_ids"])
+    return Session(**data)
+
+
+async def save_session(user_id, session):
+    await db.execute(
+        "INSERT OR REPLACE INTO sessions (user_id, blob, ts) VALUES (?, ?, ?)",
+        (user_id, orjson.dumps(session, default=list), session.last_touch),
+    )
+    await db.commit()
+
+
+def evict_sessions():
+    """Drop least recently used sessions beyond MAX_SESSIONS or idle longer than SESSION_TTL
+
+    Only the in-memory copy is dropped; a session evicted for size is reloaded from the database.
+    """
+    deadline = time.time() - SESSION_TTL
+    while sessions:
+        oldest = next(iter(sessions.values()))
+        if len(sessions) <= MAX_SESSIONS and oldest.last_touch >= deadline:
+            break
+        sessions.popitem(last=False)
 
 
-def get_session(user_id):
-    if user_id not in sessions:
-        sessions[user_id] = {"images": [], "phase": "collecting", "shipments": []}
-    return sessions[user_id]
+async def sweep_sessions():
+    """Evict idle sessions even when no updates arrive"""
+    while True:
+        await asyncio.sleep(60)
+        evict_sessions()
+        for user_id in [u for u, lock in locks.items() if u not in sessions and not lock.locked()]:
+            del locks[user_id]
+        # Carry in-memory touches (including read-only ones like /tickets) over to the rows
+        # before expiring them, with one commit per sweep instead of one per update
+        await db.executemany(
+            "UPDATE sessions SET ts = ? WHERE user_id = ?",
+            [(session.last_touch, user_id) for user_id, session in sessions.items()],
+        )
+        await db.execute("DELETE FROM sessions WHERE ts < ?", (time.time() - SESSION_TTL,))
+        await db.commit()
+
 
+async def get_session(user_id):
+    session = sessions.get(user_id)
+    if session is None:
+        session = sessions.setdefault(user_id, await load_session(user_id) or Session())
+    session.last_touch = time.time()
+    sessions.move_to_end(user_id)
+    evict_sessions()
+    return session
 
-def clear_session(user_id):
-    sessions[user_id] = {"images": [], "phase": "collecting", "shipments": []}
+
+async def clear_session(user_id):
+    sessions[user_id] = Session()
+    sessions.move_to_end(user_id)
+    await db.execute("DELETE FROM sessions WHERE user_id = ?", (user_id,))
+    await db.commit()
+
+
+allowed_ids = frozenset(int(x.strip()) for x in ALLOWED_USERS.split(",") if x.strip()) if ALLOWED_USERS else None
+
+
+def per_user(handler):
+    """Process one user's updates one at a time so concurrent updates can't interleave session changes"""
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        async with locks[update.effective_user.id]:
+            await handler(update, context)
+    return wrapper
 
 
 def is_allowed(user_id):
-    if not ALLOWED_USERS:
-        return True
-    allowed = [int(x.strip()) for x in ALLOWED_USERS.split(",") if x.strip()]
-    return user_id in allowed
+    return allowed_ids is None or user_id in allowed_ids
 
 
 # ─── Ticket generation ───
@@ -119,20 +233,41 @@ def generate_ticket(data, approved):
 
 
 # ─── AI Processing ───
-async def process_invoices(images_b64):
-    content = []
-    for i, img_b64 in enumerate(images_b64):
-        content.append({
-            "type": "image",
-            "source": {"type": "base64", "media_type": "image/jpeg", "data": img_b64},
-        })
-        content.append({"type": "text", "text": f"[Фото {i+1} из {len(images_b64)}]"})
+def _shrink_photo(bio):
+    """Downscale a photo above MAX_IMAGE_PIXELS to fit it, re-encoded as JPEG"""
+    bio.seek(0)
+    with Image.open(bio) as img:
+        w, h = img.size
+        if w * h <= MAX_IMAGE_PIXELS:
+            return bio
+        scale = (MAX_IMAGE_PIXELS / (w * h)) ** 0.5
+        img.thumbnail((int(w * scale), int(h * scale)), Image.Resampling.LANCZOS)
+        out = BytesIO()
+        img.convert("RGB").save(out, "JPEG", quality=85, optimize=True)
+    bio.close()
+    return out
+
+
+async def _fetch_b64(context, file_id):
+    file = await context.bot.get_file(file_id)
+    bio = BytesIO()
+    await file.download_to_memory(bio)
+    bio = await asyncio.to_thread(_shrink_photo, bio)
+    with bio.getbuffer() as view:
+        img_b64 = pybase64.b64encode_as_string(view)
+    bio.close()
+    return img_b64
+
+
+async def fetch_images(context, file_ids):
+    """Download all photos of the batch concurrently"""
+    tasks = [asyncio.create_task(_fetch_b64(context, fid)) for fid in file_ids]
+    return await asyncio.gather(*tasks)
+
 
-    content.append({
-        "type": "text",
-        "text": f"""Ты — система извлечения данных из инвойсов на таможенную пошлину (UPS, FedEx, DHL и др.).
+INVOICE_PROMPT = """Ты — система извлечения данных из инвойсов на таможенную пошлину (UPS, FedEx, DHL и др.).
 
-Тебе предоставлены {len(images_b64)} фото. Это могут быть страницы РАЗНЫХ инвойсов по РАЗНЫМ посылкам, или несколько страниц одного инвойса.
+Тебе предоставлены фото, каждое подписано номером. Это могут быть страницы РАЗНЫХ инвойсов по РАЗНЫМ посылкам, или несколько страниц одного инвойса.
 
 ЗАДАЧА:
 1. Определи сколько УНИКАЛЬНЫХ посылок/отправлений здесь есть (по трек-номерам, Shipment ID, или номерам инвойсов)
@@ -142,7 +277,7 @@ async def process_invoices(images_b64):
 Верни ТОЛЬКО JSON-массив (без markdown, без backticks, без пояснений):
 
 [
-  {{
+  {
     "shipmentIndex": 1,
     "pages": "какие фото относятся к этой посылке",
     "trackingNumber": "трек-номер",
@@ -162,7 +297,7 @@ async def process_invoices(images_b64):
     "carrier": "перевозчик (UPS/FedEx/DHL/другой)",
     "paymentUrl": "URL для оплаты если указан, иначе N/A",
     "notes": "замечания если есть"
-  }}
+  }
 ]
 
 Правила:
@@ -173,32 +308,99 @@ async def process_invoices(images_b64):
 - ОБЯЗАТЕЛЬНО найди дату инвойса (Invoice Date)
 - Числовые поля — только цифры с точкой, без знака доллара
 - Если поле не найдено — "N/A"
-""",
-    })
+"""
 
-    message = client.messages.create(
-        model="claude-sonnet-4-20250514",
-        max_tokens=4000,
-        messages=[{"role": "user", "content": content}],
-    )
+# Invariant instructions go first and are marked for prompt caching,
+# so repeated /done calls reuse the cached prefix; photos follow.
+PROMPT_BLOCK = {"type": "text", "text": INVOICE_PROMPT, "cache_control": {"type": "ephemeral"}}
+
+
+json_decoder = json.JSONDecoder()
 
-    text = ""
-    for block in message.content:
-        if hasattr(block, "text"):
-            text += block.text
 
-    text = text.strip().removeprefix("```json").removeprefix("```").removesuffix("```").strip()
-    parsed = json.loads(text)
-    return parsed if isinstance(parsed, list) else [parsed]
+def pop_json_objects(buf):
+    """Split complete top-level JSON objects off the front of a partial response
+
+    Returns the decoded objects and the unconsumed tail of buf.
+    """
+    objects = []
+    while (start := buf.find("{")) != -1:
+        try:
+            obj, end = json_decoder.raw_decode(buf, start)
+        except json.JSONDecodeError:
+            break
+        objects.append(obj)
+        buf = buf[end:]
+    return objects, buf
+
+
+TRANSIENT_ERROR_TYPES = {"overloaded_error", "rate_limit_error", "api_error"}
+
+
+def is_transient_error(e):
+    """Whether a Claude stream that failed after it opened is worth restarting
+
+    Failures while opening the stream were already retried by the SDK and are not
+    restarted again. Inside an open stream a dropped connection surfaces as a raw
+    httpx.TransportError, and an `error` event (typically overloaded_error) as an
+    APIStatusError carrying the 200 response.
+    """
+    if isinstance(e, httpx.TransportError):
+        return True
+    if e.status_code != 200:
+        return False
+    error = e.body.get("error") if isinstance(e.body, dict) else None
+    return isinstance(error, dict) and error.get("type") in TRANSIENT_ERROR_TYPES
+
+
+async def process_invoices(images_b64):
+    """Yield shipments one by one as soon as each is complete in the streamed response"""
+    total = len(images_b64)
+    # Images go inline: a Telegram file URL (api.telegram.org/file/bot<TOKEN>/...)
+    # carries the bot token, so it must not be handed to a third party to fetch.
+    content = [PROMPT_BLOCK] + [
+        block
+        for i, img_b64 in enumerate(images_b64, 1)
+        for block in (
+            {"type": "image", "source": {"type": "base64", "media_type": "image/jpeg", "data": img_b64}},
+            {"type": "text", "text": f"[Фото {i} из {total}]"},
+        )
+    ]
+
+    count = 0
+    for attempt in range(1, ANTHROPIC_STREAM_ATTEMPTS + 1):
+        buf = ""
+        try:
+            async with client.messages.stream(
+                model="claude-sonnet-4-20250514",
+                max_tokens=4000,
+                messages=[{"role": "user", "content": content}],
+            ) as stream:
+                async for text in stream.text_stream:
+                    shipments, buf = pop_json_objects(buf + text)
+                    for shipment in shipments:
+                        count += 1
+                        yield shipment
+            break
+        except (anthropic.APIStatusError, httpx.TransportError) as e:
+            # Once a shipment has been yielded its card is out; restarting would send it twice
+            if count or attempt == ANTHROPIC_STREAM_ATTEMPTS or not is_transient_error(e):
+                raise
+            logger.warning(f"Claude stream failed (attempt {attempt}): {e}")
+            await asyncio.sleep(random.uniform(0, 2 ** attempt))
+
+    if not count or "{" in buf:
+        raise ValueError(f"Unparsed model output: {buf[:200]!r}")
 
 
 # ─── Handlers ───
+@per_user
 async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_allowed(update.effective_user.id):
         await update.message.reply_text("⛔ У вас нет доступа к этому боту.")
         return
 
-    clear_session(update.effective_user.id)
+    await clear_session(update.effective_user.id)
     await update.message.reply_text(
         "📦 *Invoice Processor Bot*\n\n"
         "Отправьте мне фото инвойсов \\(можно несколько\\)\\.\n"
@@ -225,32 +427,38 @@ async def cmd_help(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
 
+@per_user
 async def cmd_clear(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    clear_session(update.effective_user.id)
+    await clear_session(update.effective_user.id)
     await update.message.reply_text("🗑 Очищено. Отправляйте новые фото инвойсов.")
 
 
+@per_user
 async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_allowed(update.effective_user.id):
         return
 
-    session = get_session(update.effective_user.id)
-
-    if session["phase"] != "collecting":
-        session["phase"] = "collecting"
-        session["images"] = []
-        session["shipments"] = []
+    session = await get_session(update.effective_user.id)
 
-    photo = update.message.photo[-1]
-    file = await context.bot.get_file(photo.file_id)
+    if session.phase != "collecting":
+        session.phase = "collecting"
+        session.file_ids = []
+        session.unique_ids = set()
+        session.shipments = []
 
-    bio = BytesIO()
-    await file.download_to_memory(bio)
-    bio.seek(0)
-    img_b64 = base64.b64encode(bio.read()).decode("utf-8")
+    # Sizes come smallest first; the smallest one legible enough for OCR saves bandwidth and resizing
+    photo = next(
+        (p for p in update.message.photo if max(p.width, p.height) >= MIN_PHOTO_SIDE),
+        update.message.photo[-1],
+    )
+    if photo.file_unique_id in session.unique_ids:
+        await update.message.reply_text("♻️ Это фото уже загружено — пропускаю.")
+        return
 
-    session["images"].append(img_b64)
-    count = len(session["images"])
+    session.unique_ids.add(photo.file_unique_id)
+    session.file_ids.append(photo.file_id)
+    count = len(session.file_ids)
+    await save_session(update.effective_user.id, session)
 
     await update.message.reply_text(
         f"✅ Фото {count} загружено.\n"
@@ -258,66 +466,78 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
 
+@per_user
 async def cmd_done(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_allowed(update.effective_user.id):
         return
 
-    session = get_session(update.effective_user.id)
+    session = await get_session(update.effective_user.id)
 
-    if not session["images"]:
+    if not session.file_ids:
         await update.message.reply_text("❌ Нет загруженных фото. Отправьте фото инвойсов.")
         return
 
-    count = len(session["images"])
+    count = len(session.file_ids)
     msg = await update.message.reply_text(f"⏳ Анализирую {count} фото... Подождите.")
 
+    cards = []
     try:
-        shipments = await process_invoices(session["images"])
-        session["shipments"] = []
+        images_b64 = await fetch_images(context, session.file_ids)
+        session.shipments = []
 
-        for s in shipments:
+        # Each card goes out as soon as its shipment is parsed, while the rest still streams in
+        async for s in process_invoices(images_b64):
             s["orderNumber"] = ""
             s["paymentApproved"] = True
-            session["shipments"].append(s)
-
-        session["phase"] = "review"
-
-        for i, s in enumerate(session["shipments"]):
-            await send_shipment_card(update, context, session, i)
-
-        if len(session["shipments"]) > 1:
-            await update.message.reply_text(
-                f"✅ Найдено посылок: {len(session['shipments'])}\n\n"
-                "Для каждой посылки укажите номер заказа командой:\n"
-                "`/order 1 ABC123`\n"
-                "где 1 — номер посылки, ABC123 — номер заказа\n\n"
-                "Для генерации тикетов: /tickets",
-                parse_mode="Markdown",
-            )
-        else:
-            await update.message.reply_text(
-                "✅ Найдена 1 посылка\n\n"
-                "Укажите номер заказа: `/order 1 ABC123`\n"
-                "Сгенерировать тикет: /tickets",
-                parse_mode="Markdown",
-            )
+            session.shipments.append(s)
+            idx = len(session.shipments) - 1
+            cards.append(asyncio.create_task(send_shipment_card(update, context, s, idx)))
 
+        session.phase = "review"
     except Exception as e:
         logger.error(f"Processing error: {e}")
+        # Drop the partial batch so buttons on cards already posted do nothing; /done can be rerun
+        session.shipments = []
         await context.bot.edit_message_text(
             "❌ Ошибка при распознавании. Проверьте качество фото и попробуйте снова.",
             chat_id=msg.chat_id,
             message_id=msg.message_id,
         )
+    await save_session(update.effective_user.id, session)
+
+    # A card that fails to send (e.g. Markdown it can't parse) doesn't undo the recognised batch
+    results = await asyncio.gather(*cards, return_exceptions=True)
+    for idx, result in enumerate(results):
+        if isinstance(result, Exception):
+            logger.error(f"Failed to send card {idx+1}: {result}")
+
+    if session.phase != "review":
+        return
+
+    if len(session.shipments) > 1:
+        await update.message.reply_text(
+            f"✅ Найдено посылок: {len(session.shipments)}\n\n"
+            "Для каждой посылки укажите номер заказа командой:\n"
+            "`/order 1 ABC123`\n"
+            "где 1 — номер посылки, ABC123 — номер заказа\n\n"
+            "Для генерации тикетов: /tickets",
+            parse_mode="Markdown",
+        )
+    else:
+        await update.message.reply_text(
+            "✅ Найдена 1 посылка\n\n"
+            "Укажите номер заказа: `/order 1 ABC123`\n"
+            "Сгенерировать тикет: /tickets",
+            parse_mode="Markdown",
+        )
 
 
-async def send_shipment_card(update, context, session, idx):
-    s = session["shipments"][idx]
+async def send_shipment_card(update, context, s, idx):
     num = idx + 1
     tracking = s.get("trackingNumber", "N/A")
     admin_link = f"https://www.pochtoy.com/admin-room/income_packages_list?user_id=&tracking={tracking}"
 
-    payment_text = (
+    parts = [
         f"📦 *Посылка {num}* — {s.get('shipper', 'N/A')}\n"
         f"━━━━━━━━━━━━━━━\n\n"
         f"💳 *ДАННЫЕ ДЛЯ ОПЛАТЫ:*\n"
@@ -325,15 +545,15 @@ async def send_shipment_card(update, context, session, idx):
         f"├ Дата инвойса: {s.get('invoiceDate', 'N/A')}\n"
         f"├ Сумма: *${s.get('totalCharges', 'N/A')} USD*\n"
         f"├ Трек: [{tracking}]({admin_link})\n"
-    )
+    ]
 
     if s.get("shipmentId") and s["shipmentId"] != "N/A":
-        payment_text += f"├ Shipment ID: `{s['shipmentId']}`\n"
+        parts.append(f"├ Shipment ID: `{s['shipmentId']}`\n")
 
     if s.get("accountNumber") and s["accountNumber"] != "N/A":
-        payment_text += f"├ Аккаунт: `{s['accountNumber']}`\n"
+        parts.append(f"├ Аккаунт: `{s['accountNumber']}`\n")
 
-    payment_text += (
+    parts.append(
         f"└ Перевозчик: {s.get('carrier', 'N/A')}\n\n"
         f"📋 *ДЕТАЛИ:*\n"
         f"├ Отправитель: {s.get('shipper', 'N/A')}, {s.get('shipperCountry', '')}\n"
@@ -345,7 +565,9 @@ async def send_shipment_card(update, context, session, idx):
     )
 
     if s.get("notes") and s["notes"] != "N/A" and s["notes"]:
-        payment_text += f"\n⚠️ {s['notes']}\n"
+        parts.append(f"\n⚠️ {s['notes']}\n")
+
+    payment_text = "".join(parts)
 
     buttons = []
     url = s.get("paymentUrl", "N/A")
@@ -372,44 +594,65 @@ async def send_shipment_card(update, context, session, idx):
     )
 
 
+async def set_payment_approved(query, idx, approved):
+    """Record the payment decision; returns False if the shipment no longer exists"""
+    user_id = query.from_user.id
+    async with locks[user_id]:
+        session = await get_session(user_id)
+        if idx >= len(session.shipments):
+            return False
+        session.shipments[idx]["paymentApproved"] = approved
+        await save_session(user_id, session)
+    return True
+
+
+async def cb_approve(query, idx):
+    if await set_payment_approved(query, idx, True):
+        await query.edit_message_reply_markup(reply_markup=None)
+        await query.message.reply_text(f"✅ Посылка {idx+1}: оплата отмечена как согласованная")
+
+
+async def cb_reject(query, idx):
+    if await set_payment_approved(query, idx, False):
+        await query.edit_message_reply_markup(reply_markup=None)
+        await query.message.reply_text(f"❌ Посылка {idx+1}: оплата отмечена как НЕ согласованная")
+
+
+async def cb_ticket(query, idx):
+    async with locks[query.from_user.id]:
+        session = await get_session(query.from_user.id)
+        if idx >= len(session.shipments):
+            return
+        s = session.shipments[idx]
+        ticket = generate_ticket(s, s["paymentApproved"])
+    await query.message.reply_text(
+        f"📝 *Тикет — Посылка {idx+1}:*\n\n`{ticket}`",
+        parse_mode="Markdown",
+    )
+
+
+CALLBACK_HANDLERS = {"approve": cb_approve, "reject": cb_reject, "ticket": cb_ticket}
+
+
 async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
+    # Answer right away: the user's lock may be held by a /done that is still streaming
     await query.answer()
 
-    user_id = query.from_user.id
-    session = get_session(user_id)
-    data = query.data
-
-    if data.startswith("approve_"):
-        idx = int(data.split("_")[1])
-        if idx < len(session["shipments"]):
-            session["shipments"][idx]["paymentApproved"] = True
-            await query.edit_message_reply_markup(reply_markup=None)
-            await query.message.reply_text(f"✅ Посылка {idx+1}: оплата отмечена как согласованная")
-
-    elif data.startswith("reject_"):
-        idx = int(data.split("_")[1])
-        if idx < len(session["shipments"]):
-            session["shipments"][idx]["paymentApproved"] = False
-            await query.edit_message_reply_markup(reply_markup=None)
-            await query.message.reply_text(f"❌ Посылка {idx+1}: оплата отмечена как НЕ согласованная")
-
-    elif data.startswith("ticket_"):
-        idx = int(data.split("_")[1])
-        if idx < len(session["shipments"]):
-            s = session["shipments"][idx]
-            ticket = generate_ticket(s, s["paymentApproved"])
-            await query.message.reply_text(
-                f"📝 *Тикет — Посылка {idx+1}:*\n\n`{ticket}`",
-                parse_mode="Markdown",
-            )
+    action, _, idx = query.data.partition("_")
+    handler = CALLBACK_HANDLERS.get(action)
+    if handler is None or not (idx.isascii() and idx.isdecimal()):
+        return
+
+    await handler(query, int(idx))
 
 
+@per_user
 async def cmd_order(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_allowed(update.effective_user.id):
         return
 
-    session = get_session(update.effective_user.id)
+    session = await get_session(update.effective_user.id)
 
     if not context.args or len(context.args) < 2:
         await update.message.reply_text(
@@ -423,8 +666,9 @@ async def cmd_order(update: Update, context: ContextTypes.DEFAULT_TYPE):
         idx = int(context.args[0]) - 1
         order_num = " ".join(context.args[1:])
 
-        if 0 <= idx < len(session["shipments"]):
-            session["shipments"][idx]["orderNumber"] = order_num
+        if 0 <= idx < len(session.shipments):
+            session.shipments[idx]["orderNumber"] = order_num
+            await save_session(update.effective_user.id, session)
             await update.message.reply_text(
                 f"✅ Посылка {idx+1}: номер заказа установлен → `{order_num}`",
                 parse_mode="Markdown",
@@ -435,17 +679,18 @@ async def cmd_order(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ Неверный формат. Используйте: `/order 1 ABC123`", parse_mode="Markdown")
 
 
+@per_user
 async def cmd_tickets(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_allowed(update.effective_user.id):
         return
 
-    session = get_session(update.effective_user.id)
+    session = await get_session(update.effective_user.id)
 
-    if not session["shipments"]:
+    if not session.shipments:
         await update.message.reply_text("❌ Нет распознанных посылок. Отправьте фото и нажмите /done")
         return
 
-    for i, s in enumerate(session["shipments"]):
+    for i, s in enumerate(session.shipments):
         ticket = generate_ticket(s, s["paymentApproved"])
         await update.message.reply_text(
             f"📝 *Тикет — Посылка {i+1} \\({s.get('shipper', 'N/A')}\\):*\n\n"
@@ -456,17 +701,27 @@ async def cmd_tickets(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 # ─── Main ───
 async def main():
-    # Start health check server
-    health_thread = threading.Thread(target=start_health_server, daemon=True)
-    health_thread.start()
-    logger.info(f"Health server started on port {PORT}")
+    # Start health check server (in webhook mode the webhook server owns PORT)
+    if not WEBHOOK_URL:
+        health_thread = threading.Thread(target=start_health_server, daemon=True)
+        health_thread.start()
+        logger.info(f"Health server started on port {PORT}")
 
     # Start auto-ping to prevent sleeping
     ping_thread = threading.Thread(target=auto_ping, daemon=True)
     ping_thread.start()
     logger.info("Auto-ping started (every 4 minutes)")
 
-    app = Application.builder().token(TELEGRAM_TOKEN).build()
+    app = (
+        Application.builder()
+        .token(TELEGRAM_TOKEN)
+        .http_version("2")
+        # Private chats only get the bot-wide 30/s limit here; max_retries is what rescues
+        # a burst of cards: on RetryAfter the send waits it out and is retried
+        .rate_limiter(AIORateLimiter(max_retries=3))
+        .concurrent_updates(True)
+        .build()
+    )
 
     app.add_handler(CommandHandler("start", cmd_start))
     app.add_handler(CommandHandler("help", cmd_help))
@@ -477,12 +732,29 @@ async def main():
     app.add_handler(MessageHandler(filters.PHOTO, handle_photo))
     app.add_handler(CallbackQueryHandler(handle_callback))
 
+    await open_session_db()
+    sweeper = asyncio.create_task(sweep_sessions())
+
     logger.info("Bot started!")
-    async with app:
-        await app.start()
-        await app.updater.start_polling()
-        while True:
-            await asyncio.sleep(3600)
+    try:
+        async with app:
+            await app.start()
+            if WEBHOOK_URL:
+                await app.updater.start_webhook(
+                    listen="0.0.0.0",
+                    port=PORT,
+                    url_path=TELEGRAM_TOKEN,
+                    webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{TELEGRAM_TOKEN}",
+                )
+                logger.info("Receiving updates via webhook")
+            else:
+                await app.updater.start_polling()
+            while True:
+                await asyncio.sleep(3600)
+    finally:
+        sweeper.cancel()
+        await http_client.aclose()
+        await db.close()
 
 
 if __name__ == "__main__":